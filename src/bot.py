@@ -1,21 +1,45 @@
+import asyncio
 import logging
-from typing import Set, Dict, Optional
+import math
+from bisect import bisect_right
+from typing import Dict, FrozenSet, Final, List, Optional, Tuple
 from datetime import datetime
 from dataclasses import dataclass
-import requests
-import threading
-import schedule
+import httpx
+import orjson
 import time
-from telegram.ext import Updater, CommandHandler
+from telegram import Bot, Update
+from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 from .config import config
+from .subscriptions import SubscriptionStore
 
-# Configurar logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO if not config.debug else logging.DEBUG
-)
 logger = logging.getLogger(__name__)
 
+# Formateador de precios ya enlazado para no reinterpretar el formato en cada llamada
+_FMT_PRICE: Final = "${:,.2f} MXN".format
+
+# Emoji asociado a cada criptomoneda
+_CRYPTO_EMOJIS: Final[Dict[str, str]] = {
+    'BTC': '₿',
+    'ETH': '⟠',
+    'XRP': '✘',
+    'MANA': '🌐',
+    'ADA': '⟁',
+    'SOL': '◎',
+    'USDT': '₮',
+    'DOT': '●',
+    'MATIC': '⬡',
+    'USDC': '₵'
+}
+
+# Umbrales (en % absoluto) que separan: sin cambio | leve | moderado | fuerte.
+# El último usa nextafter para que un cambio de exactamente 5% siga siendo moderado.
+_CHANGE_THRESHOLDS: Final[Tuple[float, ...]] = (0.01, 0.1, math.nextafter(5, math.inf))
+
+# (flecha, emoji de tendencia) por nivel de cambio
+_UP_EMOJIS: Final[Tuple[Tuple[str, str], ...]] = (("→", ""), ("→", "📈"), ("↗️", "📈"), ("⤊", "📈"))
+_DOWN_EMOJIS: Final[Tuple[Tuple[str, str], ...]] = (("→", ""), ("→", "📉"), ("↘️", "📉"), ("⤋", "📉"))
+
 @dataclass
 class PriceInfo:
     """Almacena información sobre el precio de una criptomoneda"""
@@ -26,16 +50,60 @@ class PriceInfo:
 class BitsoPriceClient:
     """Cliente para obtener precios de Bitso"""
     
+    # Segundos durante los que se reutiliza un precio ya consultado
+    cache_ttl = 10.0
+    
     def __init__(self):
         self.base_url = config.bitso.api_base_url
+        # URLs del ticker ya codificadas para cada par configurado
+        self._ticker_urls: Dict[str, str] = {
+            book: f"{self.base_url}/ticker/?book={book}" for book in config.bitso.trading_pairs
+        }
         self.price_history: Dict[str, PriceInfo] = {}
+        self._cache: Dict[str, Tuple[float, PriceInfo]] = {}
+        # Un lock por par para que las consultas concurrentes compartan una sola petición
+        self._locks: Dict[str, asyncio.Lock] = {
+            book: asyncio.Lock() for book in config.bitso.trading_pairs
+        }
+        # Cliente HTTP/2: todas las consultas de un lote se multiplexan en una sola conexión
+        self._client = httpx.AsyncClient(
+            headers={'Accept': 'application/json', 'User-Agent': 'bitso-bot/1.0'},
+            timeout=httpx.Timeout(5.0, connect=3.0),
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=3,
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=4)
+            )
+        )
         
-    def get_price(self, book: str) -> Optional[PriceInfo]:
+    async def get_price(self, book: str, now: Optional[datetime] = None) -> Optional[PriceInfo]:
         """Obtiene el precio actual y lo compara con el anterior"""
+        info = self._cached_price(book)
+        if info:
+            return info
+        
+        lock = self._locks.get(book) or self._locks.setdefault(book, asyncio.Lock())
+        async with lock:
+            # Otra consulta pudo haber actualizado el precio mientras se esperaba el lock
+            return self._cached_price(book) or await self._fetch_price(book, now)
+    
+    def _cached_price(self, book: str) -> Optional[PriceInfo]:
+        """Devuelve el precio en caché si todavía está vigente"""
+        ts, info = self._cache.get(book, (0.0, None))
+        if info and time.monotonic() - ts < self.cache_ttl:
+            return info
+        return None
+    
+    async def _fetch_price(self, book: str, now: Optional[datetime]) -> Optional[PriceInfo]:
+        """Consulta el ticker de Bitso y actualiza el historial"""
         try:
-            response = requests.get(f"{self.base_url}/ticker/", params={'book': book})
-            response.raise_for_status()
-            data = response.json()
+            url = self._ticker_urls.get(book) or f"{self.base_url}/ticker/?book={book}"
+            response = await self._client.get(url)
+            if response.status_code >= 400:
+                logger.error(f"Error HTTP {response.status_code} obteniendo precio de {book}")
+                return None
+            
+            data = orjson.loads(response.content)
             
             if data['success']:
                 current_price = float(data['payload']['last'])
@@ -47,11 +115,12 @@ class BitsoPriceClient:
                 new_info = PriceInfo(
                     current_price=current_price,
                     last_price=last_info.current_price if last_info else None,
-                    last_update=datetime.now()
+                    last_update=now or datetime.now()
                 )
                 
-                # Actualizar historial
+                # Actualizar historial y caché
                 self.price_history[book] = new_info
+                self._cache[book] = (time.monotonic(), new_info)
                 
                 return new_info
             
@@ -61,16 +130,63 @@ class BitsoPriceClient:
         except Exception as e:
             logger.error(f"Error obteniendo precio de {book}: {str(e)}")
             return None
+    
+    async def get_prices(
+        self, books: List[str], now: Optional[datetime] = None
+    ) -> Dict[str, Optional[PriceInfo]]:
+        """Obtiene los precios de varios pares en paralelo, respetando el orden recibido"""
+        # Un único timestamp para todo el lote
+        now = now or datetime.now()
+        results = await asyncio.gather(*(self.get_price(book, now) for book in books))
+        return dict(zip(books, results))
+    
+    def invalidate(self):
+        """Descarta los precios en caché para forzar una nueva consulta"""
+        self._cache.clear()
+    
+    async def aclose(self):
+        """Cierra las conexiones abiertas con Bitso"""
+        await self._client.aclose()
 
 class BitsoTelegramBot:
     """Bot de Telegram para mostrar precios de Bitso"""
     
+    # Segundos durante los que se reutiliza el último mensaje formateado
+    message_ttl = 5.0
+    
+    # Actualizaciones programadas seguidas sin ningún precio a partir de las cuales se omite el envío
+    max_consecutive_failures = 3
+    
+    # Envíos simultáneos a Telegram durante una actualización programada
+    max_concurrent_sends = 16
+    
     def __init__(self):
         """Inicializa el bot con la configuración"""
         self.price_client = BitsoPriceClient()
-        self.updater = Updater(config.bot.token, use_context=True)
-        self.dp = self.updater.dispatcher
-        self.chats_activos: Set[int] = set()
+        self.app = (
+            ApplicationBuilder()
+            .token(config.bot.token)
+            .concurrent_updates(True)
+            .post_init(self._on_startup)
+            .post_shutdown(self._on_shutdown)
+            .build()
+        )
+        self.subscriptions = SubscriptionStore(config.bot.subscriptions_db)
+        # Conjunto inmutable: las lecturas toman una instantánea sin copiar y
+        # las escrituras lo reemplazan completo (todas ocurren en el event loop)
+        self._chats: FrozenSet[int] = self.subscriptions.load()
+        # (momento, mensaje, si se obtuvo al menos un precio)
+        self._msg_cache: Optional[Tuple[float, str, bool]] = None
+        # Serializa la regeneración del mensaje para que las llamadas concurrentes la compartan
+        self._msg_lock = asyncio.Lock()
+        # Actualizaciones programadas seguidas sin ningún precio disponible
+        self._failed_ticks = 0
+        self._send_semaphore = asyncio.Semaphore(self.max_concurrent_sends)
+        
+        # Símbolo de cada par calculado una sola vez (p. ej. 'btc_mxn' -> 'BTC')
+        self._pair_crypto: Dict[str, str] = {
+            pair: pair.split('_')[0].upper() for pair in config.bitso.trading_pairs
+        }
         
         # Registrar manejadores de comandos
         self._register_handlers()
@@ -86,7 +202,7 @@ class BitsoTelegramBot:
         }
         
         for command, callback in commands.items():
-            self.dp.add_handler(CommandHandler(command, callback))
+            self.app.add_handler(CommandHandler(command, callback))
     
     def get_price_change_emoji(self, price_info: PriceInfo) -> tuple[str, str, str]:
         """
@@ -100,147 +216,199 @@ class BitsoTelegramBot:
             
         change = ((price_info.current_price - price_info.last_price) / price_info.last_price) * 100
         
+        # Ubicar la magnitud del cambio en la tabla de umbrales
+        level = bisect_right(_CHANGE_THRESHOLDS, abs(change))
+        
         # Si el cambio es muy cercano a 0 (menos de 0.01%), lo tratamos como sin cambio
-        if abs(change) < 0.01:
+        if not level:
             return "→", "(0.00%)", ""
-            
-        # Tendencia para cambios significativos
-        trend_emoji = "📈" if change > 0 else "📉"
-        
-        if abs(change) < 0.1:
-            return "→", f"({change:+.2f}%)", trend_emoji
-        elif change > 0:
-            if change > 5:
-                return "⤊", f"({change:+.2f}%)", trend_emoji
-            else:
-                return "↗️", f"({change:+.2f}%)", trend_emoji
-        else:
-            if change < -5:
-                return "⤋", f"({change:.2f}%)", trend_emoji
-            else:
-                return "↘️", f"({change:.2f}%)", trend_emoji
+        
+        arrow, trend_emoji = (_UP_EMOJIS if change > 0 else _DOWN_EMOJIS)[level]
+        return arrow, f"({change:+.2f}%)", trend_emoji
 
-    def format_price_message(self) -> str:
+    async def format_price_message(self) -> str:
         """Formatea el mensaje con los precios actuales y sus variaciones"""
-        crypto_emojis = {
-            'BTC': '₿',
-            'ETH': '⟠',
-            'XRP': '✘',
-            'MANA': '🌐',
-            'ADA': '⟁',
-            'SOL': '◎',
-            'USDT': '₮',
-            'DOT': '●',
-            'MATIC': '⬡',
-            'USDC': '₵'
-        }
-
-        mensaje = "💰 Precios actuales en Bitso:\n\n"
+        mensaje, _ = await self._price_message()
+        return mensaje
+    
+    async def _price_message(self) -> Tuple[str, bool]:
+        """Devuelve el mensaje de precios y si se obtuvo al menos un precio"""
+        cached = self._msg_cache
+        if cached and time.monotonic() - cached[0] < self.message_ttl:
+            return cached[1], cached[2]
+        
+        async with self._msg_lock:
+            # Otra llamada pudo haber generado el mensaje mientras se esperaba el lock
+            cached = self._msg_cache
+            if cached and time.monotonic() - cached[0] < self.message_ttl:
+                return cached[1], cached[2]
+            return await self._build_price_message()
+    
+    async def _build_price_message(self) -> Tuple[str, bool]:
+        """Consulta los precios y arma el mensaje, guardándolo en caché"""
+        parts = ["💰 Precios actuales en Bitso:", ""]
+        
+        now = datetime.now()
+        prices = await self.price_client.get_prices(config.bitso.trading_pairs, now)
         
-        for pair in config.bitso.trading_pairs:
-            price_info = self.price_client.get_price(pair)
+        for pair, price_info in prices.items():
+            crypto = self._pair_crypto[pair]
+            emoji = _CRYPTO_EMOJIS.get(crypto, '🪙')
+            
             if price_info:
-                crypto = pair.split('_')[0].upper()
-                emoji = crypto_emojis.get(crypto, '🪙')
-                
                 # Obtener emoji, texto de variación y tendencia
                 change_emoji, change_text, trend_emoji = self.get_price_change_emoji(price_info)
                 
                 # Solo agregar el emoji de tendencia si hay un cambio significativo
                 trend_display = f" {trend_emoji}" if trend_emoji else ""
                 
-                mensaje += (
-                    f"{crypto} {emoji}: ${price_info.current_price:,.2f} MXN "
-                    f"{change_emoji}{trend_display}{change_text}\n"
+                parts.append(
+                    f"{crypto} {emoji}: {_FMT_PRICE(price_info.current_price)} "
+                    f"{change_emoji}{trend_display}{change_text}"
                 )
             else:
-                crypto = pair.split('_')[0].upper()
-                emoji = crypto_emojis.get(crypto, '🪙')
-                mensaje += f"{emoji} {crypto}: No disponible ❌\n"
+                parts.append(f"{emoji} {crypto}: No disponible ❌")
         
-        mensaje += f"\nÚltima actualización: {datetime.now().strftime('%H:%M:%S')}"
-        return mensaje
+        # Mostrar la hora del precio más antiguo incluido, que puede venir de la caché
+        disponible = any(prices.values())
+        if disponible:
+            now = min(info.last_update for info in prices.values() if info)
+        
+        parts += ["", f"Última actualización: {now:%H:%M:%S}"]
+        mensaje = "\n".join(parts)
+        self._msg_cache = (time.monotonic(), mensaje, disponible)
+        return mensaje, disponible
     
-    def cmd_start(self, update, context):
+    async def cmd_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Maneja los comandos /start y /ayuda"""
-        update.message.reply_text(config.bot.welcome_message)
+        await update.message.reply_text(config.bot.welcome_message)
         
-    def cmd_precio(self, update, context):
+    async def cmd_precio(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Maneja el comando /precio"""
-        mensaje = self.format_price_message()
-        update.message.reply_text(mensaje)
+        mensaje = await self.format_price_message()
+        await update.message.reply_text(mensaje)
         
-    def cmd_activar(self, update, context):
+    async def cmd_activar(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Maneja el comando /activar"""
         chat_id = update.effective_chat.id
         
-        if chat_id in self.chats_activos:
-            update.message.reply_text("⚠️ Las actualizaciones automáticas ya están activadas.")
+        if chat_id in self._chats:
+            await update.message.reply_text("⚠️ Las actualizaciones automáticas ya están activadas.")
             return
             
-        self.chats_activos.add(chat_id)
-        update.message.reply_text(
+        self._add_chat(chat_id)
+        await update.message.reply_text(
             f"✅ Actualizaciones automáticas activadas.\n"
             f"Recibirás precios cada {config.bitso.update_interval} minutos."
         )
         
-    def cmd_desactivar(self, update, context):
+    async def cmd_desactivar(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Maneja el comando /desactivar"""
         chat_id = update.effective_chat.id
         
-        if chat_id not in self.chats_activos:
-            update.message.reply_text("⚠️ Las actualizaciones automáticas ya están desactivadas.")
+        if chat_id not in self._chats:
+            await update.message.reply_text("⚠️ Las actualizaciones automáticas ya están desactivadas.")
             return
             
-        self.chats_activos.discard(chat_id)
-        update.message.reply_text("❌ Actualizaciones automáticas desactivadas.")
+        self._remove_chat(chat_id)
+        await update.message.reply_text("❌ Actualizaciones automáticas desactivadas.")
         
-    def enviar_actualizacion(self):
+    async def enviar_actualizacion(self, context: ContextTypes.DEFAULT_TYPE):
         """Envía actualizaciones de precios a todos los chats activos"""
-        if not self.chats_activos:
+        if not self._chats:
+            return
+        
+        # Las actualizaciones programadas siempre consultan precios y generan un mensaje nuevo
+        self.price_client.invalidate()
+        self._msg_cache = None
+        mensaje, disponible = await self._price_message()
+        self._failed_ticks = 0 if disponible else self._failed_ticks + 1
+        
+        # Si Bitso no responde, no saturar los chats con "No disponible"
+        if self._failed_ticks >= self.max_consecutive_failures:
+            logger.warning(
+                f"Bitso sin respuesta en {self._failed_ticks} actualizaciones seguidas, se omite el envío"
+            )
             return
+        
+        # Instantánea inmutable: no hace falta copiarla para iterar
+        chats = self._chats
+        await asyncio.gather(*(self._send_safe(context.bot, chat_id, mensaje) for chat_id in chats))
+    
+    async def _send_safe(self, bot: Bot, chat_id: int, mensaje: str):
+        """Envía la actualización a un chat, descartándolo si ya no es alcanzable"""
+        try:
+            async with self._send_semaphore:
+                await bot.send_message(chat_id=chat_id, text=mensaje)
+            logger.debug(f"Actualización enviada a {chat_id}")
+        except Exception as e:
+            logger.error(f"Error enviando mensaje a {chat_id}: {str(e)}")
+            # Si el chat ya no existe o el bot fue expulsado, lo removemos.
+            # PTB capitaliza los mensajes de la API ("Chat not found"), por eso se compara en minúsculas
+            error = str(e).lower()
+            if "bot was blocked by the user" in error or "chat not found" in error:
+                self._remove_chat(chat_id)
+    
+    # Las escrituras en SQLite son bloqueantes y corren en el event loop; al ser
+    # inserciones/borrados de una sola fila en autocommit su costo es despreciable
+    def _add_chat(self, chat_id: int):
+        """Agrega un chat a las actualizaciones automáticas"""
+        self.subscriptions.add(chat_id)
+        self._chats = self._chats | {chat_id}
+    
+    def _remove_chat(self, chat_id: int):
+        """Quita un chat de las actualizaciones automáticas"""
+        self.subscriptions.remove(chat_id)
+        self._chats = self._chats - {chat_id}
             
-        mensaje = self.format_price_message()
-        
-        for chat_id in list(self.chats_activos):  # Usar lista para evitar modificación durante iteración
-            try:
-                self.updater.bot.send_message(chat_id=chat_id, text=mensaje)
-                logger.debug(f"Actualización enviada a {chat_id}")
-            except Exception as e:
-                logger.error(f"Error enviando mensaje a {chat_id}: {str(e)}")
-                # Si el chat ya no existe o el bot fue expulsado, lo removemos
-                if "bot was blocked by the user" in str(e) or "chat not found" in str(e):
-                    self.chats_activos.discard(chat_id)
-                    
-    def run_schedule(self):
-        """Ejecuta el planificador de tareas en un hilo separado"""
-        schedule.every(config.bitso.update_interval).minutes.do(self.enviar_actualizacion)
-        
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+    async def _on_startup(self, app):
+        """Se ejecuta cuando la aplicación terminó de inicializarse"""
+        logger.info("Bot iniciado exitosamente!")
+            
+    async def _on_shutdown(self, app):
+        """Libera los recursos al detener el bot"""
+        await self.price_client.aclose()
+        self.subscriptions.close()
             
     def run(self):
         """Inicia el bot"""
         try:
             logger.info("Iniciando bot...")
+            logger.info(f"Chats con actualizaciones automáticas restaurados: {len(self._chats)}")
             
-            # Iniciar planificador en un hilo separado
-            threading.Thread(target=self.run_schedule, daemon=True).start()
-            
-            # Iniciar el bot
-            self.updater.start_polling()
-            logger.info("Bot iniciado exitosamente!")
+            # Programar las actualizaciones automáticas en el JobQueue del bot
+            interval = config.bitso.update_interval * 60
+            self.app.job_queue.run_repeating(self.enviar_actualizacion, interval=interval, first=interval)
             
-            # Mantener el bot corriendo
-            self.updater.idle()
+            # Iniciar el bot hasta recibir SIGINT/SIGTERM:
+            # webhook si hay un endpoint público, polling en local
+            if config.bot.webhook_base:
+                self.app.run_webhook(
+                    listen='0.0.0.0',
+                    port=config.bot.port,
+                    url_path=config.bot.token,
+                    webhook_url=f"{config.bot.webhook_base.rstrip('/')}/{config.bot.token}"
+                )
+            else:
+                self.app.run_polling()
             
         except Exception as e:
             logger.error(f"Error al iniciar el bot: {str(e)}")
             raise
 
+def configure_logging():
+    """Configura el logging raíz si todavía no tiene handlers"""
+    if not logging.getLogger().handlers:
+        logging.basicConfig(
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            level=logging.INFO if not config.debug else logging.DEBUG
+        )
+    # httpx registra cada petición en INFO, incluida la URL de Telegram con el token del bot
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
 def main():
     """Función principal"""
+    configure_logging()
     bot = BitsoTelegramBot()
     bot.run()
 
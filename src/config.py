@@ -1,6 +1,6 @@
 import os
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,6 +9,9 @@ load_dotenv()
 class BotConfig:
     """Configuración relacionada con el bot de Telegram"""
     token: str
+    webhook_base: Optional[str] = None
+    port: int = 8443
+    subscriptions_db: str = 'subs.db'
     welcome_message: str = """
 ¡Hola! 👋 Soy el Bot de test de rama de precios de Bitso
 
@@ -48,7 +51,10 @@ def load_config() -> Config:
         raise ValueError("No se encontró TELEGRAM_TOKEN en variables de entorno")
 
     bot_config = BotConfig(
-        token=token
+        token=token,
+        webhook_base=os.getenv('WEBHOOK_BASE') or None,
+        port=int(os.getenv('PORT', '8443')),
+        subscriptions_db=os.getenv('SUBSCRIPTIONS_DB', 'subs.db')
     )
 
     # Configuración de Bitso
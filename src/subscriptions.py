@@ -0,0 +1,30 @@
+import sqlite3
+from typing import FrozenSet
+
+class SubscriptionStore:
+    """Persiste en SQLite los chats con actualizaciones automáticas activas"""
+    
+    def __init__(self, path: str):
+        """Abre (o crea) la base de datos de suscripciones"""
+        # Autocommit + WAL con synchronous=NORMAL: cada comando se guarda sin bloquear
+        # lecturas y el fsync se hace solo en los checkpoints, no en cada commit
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chats(chat_id INTEGER PRIMARY KEY)")
+        
+    def load(self) -> FrozenSet[int]:
+        """Devuelve todos los chats suscritos"""
+        return frozenset(row[0] for row in self.conn.execute("SELECT chat_id FROM chats"))
+    
+    def add(self, chat_id: int):
+        """Registra un chat suscrito"""
+        self.conn.execute("INSERT OR IGNORE INTO chats(chat_id) VALUES (?)", (chat_id,))
+        
+    def remove(self, chat_id: int):
+        """Elimina un chat de las suscripciones"""
+        self.conn.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
+        
+    def close(self):
+        """Cierra la conexión a la base de datos"""
+        self.conn.close()